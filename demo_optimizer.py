@@ -75,7 +75,7 @@ if __name__ == "__main__":
     decoder = DeepSDF(latent_size, **specs["NetworkSpecs"])
     decoder = torch.nn.DataParallel(decoder)
 
-    saved_model_state = torch.load(
+    saved_model_state = load_checkpoint(
         os.path.join(
             args.experiment_directory, model_params_subdir, "latest.pth"
         )
@@ -98,7 +98,7 @@ if __name__ == "__main__":
     latent_filename = os.path.join(
         reconstruction_codes_dir, "latest.pth"
     )
-    latent = torch.load(latent_filename)["latent_codes"]["weight"]
+    latent = load_checkpoint(latent_filename)["latent_codes"]["weight"].cuda()
 
     latent_init = latent[1]
     latent_init.requires_grad = True
@@ -111,9 +111,9 @@ if __name__ == "__main__":
     intrinsic, extrinsic = get_projection(azimuth, elevation, camera_distance, img_w=args.image_resolution, img_h=args.image_resolution)
 
     # set up renderer
-    K_cuda = torch.tensor(intrinsic[np.newaxis, :, :].copy()).float().cuda().unsqueeze(0)
-    R_cuda = torch.tensor(extrinsic[np.newaxis, 0:3, 0:3].copy()).float().cuda().unsqueeze(0)
-    t_cuda = torch.tensor(extrinsic[np.newaxis, np.newaxis, 0:3, 3].copy()).float().cuda().unsqueeze(0)
+    K_cuda = torch.tensor(intrinsic.copy()).float().cuda().unsqueeze(0)
+    R_cuda = torch.tensor(extrinsic[0:3, 0:3].copy()).float().cuda().unsqueeze(0)
+    t_cuda = torch.tensor(extrinsic[np.newaxis, 0:3, 3].copy()).float().cuda().unsqueeze(0)
     renderer = nr.Renderer(image_size = args.image_resolution, orig_size = args.image_resolution, K=K_cuda, R=R_cuda, t=t_cuda, anti_aliasing=False)
 
     verts_target, faces_target, _ , _ = lib.mesh.create_mesh(decoder, latent_target, N=args.resolution, output_mesh = True)
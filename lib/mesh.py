@@ -119,6 +119,13 @@ def convert_sdf_samples_to_mesh(
     return mesh_points, faces
 
 
+def get_latent_bias(decoder, latent_vec):
+    # wrapped decoders (e.g. DataParallel) split the batch, keep materializing the latent codes there
+    if not hasattr(decoder, "latent_bias"):
+        return None
+    return decoder.latent_bias(latent_vec)
+
+
 def create_mesh(
     decoder, latent_vec, N=256, max_batch=32 ** 3, offset=None, scale=None, output_mesh = False, filename = None
 ):
@@ -152,10 +159,11 @@ def create_mesh(
 
     head = 0
 
+    latent_bias = get_latent_bias(decoder, latent_vec)
     while head < num_samples:
         sample_subset = samples[head : min(head + max_batch, num_samples), 0:3].cuda()
         samples[head : min(head + max_batch, num_samples), 3] = (
-            decode_sdf(decoder, latent_vec, sample_subset)
+            decode_sdf(decoder, latent_vec, sample_subset, latent_bias)
             .squeeze(1)
             .detach()
             .cpu()
@@ -221,10 +229,11 @@ def create_mesh_optim_fast(
     with torch.no_grad():
 
         head = 0
+        latent_bias = get_latent_bias(decoder, latent_vec)
         while head < num_samples:
             sample_subset = samples[indices[head : min(head + max_batch, num_samples)], 0:3].reshape(-1, 3).cuda()
             samples[indices[head : min(head + max_batch, num_samples)], 3] = (
-                decode_sdf(decoder, latent_vec, sample_subset)
+                decode_sdf(decoder, latent_vec, sample_subset, latent_bias)
                 .squeeze(1)
                 .detach()
                 .cpu()
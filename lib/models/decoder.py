@@ -33,6 +33,7 @@ class DeepSDF(nn.Module):
         else:
             dims = [latent_size + 3] + dims + [1]
 
+        self.latent_size = latent_size
         self.positional_encoding = positional_encoding
         self.fourier_degree = fourier_degree
         self.num_layers = len(dims)
@@ -78,14 +79,31 @@ class DeepSDF(nn.Module):
         self.dropout = dropout
         self.th = nn.Tanh()
 
+    # contribution of a single latent vector to the first layer, bias included
+    # needs to be recomputed whenever the decoder parameters change
+    def latent_bias(self, latent_vector):
+        latent_vector = latent_vector.reshape(1, -1)
+        xyz_zeros = latent_vector.new_zeros(1, self.lin0.in_features - self.latent_size)
+        return self.lin0(torch.cat([latent_vector, xyz_zeros], dim=1))
+
     # input: N x (L+3)
-    def forward(self, latent, xyz):
+    # if latent_bias is given, latent is a single vector shared by all N points
+    def forward(self, latent, xyz, latent_bias=None):
 
         if self.positional_encoding:
-            xyz = fourier_transform(xyz, self.fourier_degree)
-        input = torch.cat([latent, xyz.cuda()], dim=1)
-
-        if input.shape[1] > 3 and self.latent_dropout:
+            # match the decoder precision, e.g. bfloat16 halves the traffic of the first layer
+            xyz = fourier_transform(xyz, self.fourier_degree, dtype=self.lin0.bias.dtype)
+        xyz = xyz.cuda()
+        use_latent_bias = latent_bias is not None and not self.latent_dropout
+        if latent_bias is not None:
+            latent = latent.reshape(1, -1).expand(xyz.shape[0], -1)
+        # with a latent bias, the full input is only materialized for latent_in layers
+        if not use_latent_bias or len(self.latent_in) > 0:
+            input = torch.cat([latent, xyz], dim=1)
+
+        if use_latent_bias:
+            x = xyz
+        elif input.shape[1] > 3 and self.latent_dropout:
             latent_vecs = input[:, :-3]
             latent_vecs = F.dropout(latent_vecs, p=0.2, training=self.training)
             x = torch.cat([latent_vecs, xyz], 1)
@@ -98,7 +116,11 @@ class DeepSDF(nn.Module):
                 x = torch.cat([x, input], 1)
             elif layer != 0 and self.xyz_in_all:
                 x = torch.cat([x, xyz], 1)
-            x = lin(x)
+            if layer == 0 and use_latent_bias:
+                # the latent part of the first layer is shared, only multiply the coordinates
+                x = F.linear(x, lin.weight[:, self.latent_size:]) + latent_bias
+            else:
+                x = lin(x)
             # last layer Tanh
             if layer == self.num_layers - 2 and self.use_tanh:
                 x = self.tanh(x)
@@ -1,7 +1,16 @@
 #!/usr/bin/env python3
+import io
 import os
+import copy
+import functools
+import json
+import math
+import struct
 import pdb
 import logging
+import logging.handlers
+import queue
+import atexit
 import torch
 import trimesh
 import glob
@@ -9,30 +18,56 @@ import lib.workspace as ws
 import numpy as np
 import imageio
 
+_pinned_buffers = {}
+
+
+def _copy_to_host(tensor):
+    """Copy a tensor to host memory, staging CUDA tensors through a reused pinned buffer."""
+    if not tensor.is_cuda:
+        return tensor
+    key = (tuple(tensor.shape), tensor.dtype)
+    if key not in _pinned_buffers:
+        _pinned_buffers[key] = torch.empty(tensor.shape, dtype=tensor.dtype, pin_memory=True)
+    host = _pinned_buffers[key]
+    host.copy_(tensor, non_blocking=True)
+    torch.cuda.current_stream(tensor.device).synchronize()
+    return host
+
+
+@torch.no_grad()
+def _quantize_image(images_out, alpha_out):
+    # assemble RGBA and quantize on device, so that only uint8 data is transferred
+    image_out_export = torch.cat((images_out[0], alpha_out[0].unsqueeze(0)), 0)
+    image_out_export = image_out_export.mul(255).clamp_(0, 255).to(torch.uint8)
+    return image_out_export.permute(1, 2, 0).contiguous()  # [image_size, image_size, RGBA]
+
+
 def process_image(images_out, alpha_out):
-    image_out_export = 255*images_out.detach().cpu().numpy()[0].transpose((1, 2, 0))  # [image_size, image_size, RGB]
-    alpha_out_export = 255*alpha_out.detach().cpu().numpy()[0]
-    image_out_export = np.concatenate( (image_out_export, alpha_out_export[:,:,np.newaxis]), -1 )
-    return image_out_export.astype(np.uint8)
+    # the pinned staging buffer is reused across calls, hand out a copy
+    return _copy_to_host(_quantize_image(images_out, alpha_out)).numpy().copy()
 
 def store_image(image_filename, images_out, alpha_out):
-    image_out_export = process_image(images_out, alpha_out)
-    imageio.imwrite(image_filename, image_out_export)
+    image_out_export = _copy_to_host(_quantize_image(images_out, alpha_out))
+    imageio.imwrite(image_filename, image_out_export.numpy())
 
 def interpolate_on_faces(field, faces):
     #TODO: no batch support for now
-    nv = field.shape[0]
+    # pytorch only supports long tensors for index_select, pass long faces to avoid a copy
+    if faces.dtype != torch.long:
+        faces = faces.long()
+    faces = faces.reshape(-1, 3)
     nf = faces.shape[0]
-    field = field.reshape((nv, 1))
-    # pytorch only supports long and byte tensors for indexing
-    face_coordinates = field[faces.long()].squeeze(0)
-    centroids = 1.0/3 * torch.sum(face_coordinates, 1)
+    face_values = torch.index_select(field.reshape(-1), 0, faces.reshape(-1)).view(nf, 3)
+    centroids = face_values.mean(1, keepdim=True)
     return centroids
 
 class LearningRateSchedule:
     def get_learning_rate(self, epoch):
         pass
 
+    def get_learning_rates(self, epochs):
+        return np.array([self.get_learning_rate(epoch) for epoch in epochs])
+
 
 class ConstantLearningRateSchedule(LearningRateSchedule):
     def __init__(self, value):
@@ -41,6 +76,9 @@ class ConstantLearningRateSchedule(LearningRateSchedule):
     def get_learning_rate(self, epoch):
         return self.value
 
+    def get_learning_rates(self, epochs):
+        return np.full(np.shape(epochs), self.value, dtype=np.float64)
+
 
 class StepLearningRateSchedule(LearningRateSchedule):
     def __init__(self, initial, interval, factor):
@@ -52,6 +90,10 @@ class StepLearningRateSchedule(LearningRateSchedule):
 
         return self.initial * (self.factor ** (epoch // self.interval))
 
+    def get_learning_rates(self, epochs):
+        epochs = np.asarray(epochs)
+        return self.initial * (self.factor ** (epochs // self.interval))
+
 
 class WarmupLearningRateSchedule(LearningRateSchedule):
     def __init__(self, initial, warmed_up, length):
@@ -64,6 +106,22 @@ class WarmupLearningRateSchedule(LearningRateSchedule):
             return self.warmed_up
         return self.initial + (self.warmed_up - self.initial) * epoch / self.length
 
+    def get_learning_rates(self, epochs):
+        epochs = np.asarray(epochs)
+        return np.where(
+            epochs > self.length,
+            self.warmed_up,
+            self.initial + (self.warmed_up - self.initial) * epochs / self.length,
+        )
+
+
+# schedule type -> (schedule class, spec keys of its constructor arguments)
+learning_rate_schedule_types = {
+    "Step": (StepLearningRateSchedule, ("Initial", "Interval", "Factor")),
+    "Warmup": (WarmupLearningRateSchedule, ("Initial", "Final", "Length")),
+    "Constant": (ConstantLearningRateSchedule, ("Value",)),
+}
+
 
 def get_learning_rate_schedules(specs):
 
@@ -71,44 +129,130 @@ def get_learning_rate_schedules(specs):
 
     schedules = []
 
-    for schedule_specs in schedule_specs:
-
-        if schedule_specs["Type"] == "Step":
-            schedules.append(
-                StepLearningRateSchedule(
-                    schedule_specs["Initial"],
-                    schedule_specs["Interval"],
-                    schedule_specs["Factor"],
-                )
-            )
-        elif schedule_specs["Type"] == "Warmup":
-            schedules.append(
-                WarmupLearningRateSchedule(
-                    schedule_specs["Initial"],
-                    schedule_specs["Final"],
-                    schedule_specs["Length"],
-                )
-            )
-        elif schedule_specs["Type"] == "Constant":
-            schedules.append(ConstantLearningRateSchedule(schedule_specs["Value"]))
+    for schedule_spec in schedule_specs:
 
-        else:
+        if schedule_spec["Type"] not in learning_rate_schedule_types:
             raise Exception(
                 'no known learning rate schedule of type "{}"'.format(
-                    schedule_specs["Type"]
+                    schedule_spec["Type"]
                 )
             )
 
+        schedule_class, arg_keys = learning_rate_schedule_types[schedule_spec["Type"]]
+        schedules.append(schedule_class(*[schedule_spec[key] for key in arg_keys]))
+
     return schedules
 
 
+_pinned_state_buffers = {}
+
+
+def _state_to_pinned_host(obj, used):
+    if torch.is_tensor(obj):
+        if not obj.is_cuda:
+            return obj
+        key = (tuple(obj.shape), obj.dtype)
+        index = used.get(key, 0)
+        used[key] = index + 1
+        buffers = _pinned_state_buffers.setdefault(key, [])
+        if index == len(buffers):
+            buffers.append(torch.empty(obj.shape, dtype=obj.dtype, pin_memory=True))
+        return buffers[index].copy_(obj.detach(), non_blocking=True)
+    if isinstance(obj, dict):
+        host = type(obj)((k, _state_to_pinned_host(v, used)) for k, v in obj.items())
+        if hasattr(obj, "_metadata"):
+            host._metadata = obj._metadata
+        return host
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_state_to_pinned_host(v, used) for v in obj)
+    return obj
+
+
+def state_dict_to_cpu(state_dict):
+    """Copy all CUDA tensors of a (nested) state dict to reused pinned buffers, synchronizing once.
+
+    The returned tensors are overwritten by the next call, so they have to be serialized right away.
+    """
+    used = {}
+    host_state_dict = _state_to_pinned_host(state_dict, used)
+    if used:
+        torch.cuda.synchronize()
+    return host_state_dict
+
+
+def _write_atomically(*chunks, filename):
+    tmp_filename = filename + ".tmp"
+    with open(tmp_filename, "wb") as f:
+        for chunk in chunks:
+            f.write(chunk)
+    os.replace(tmp_filename, filename)
+
+
+def save_checkpoint(obj, filename):
+    """Serialize obj in memory, then write it with a single call and atomically move it into place."""
+    buffer = io.BytesIO()
+    torch.save(obj, buffer)
+    _write_atomically(buffer.getbuffer(), filename=filename)
+
+
+def save_tensor_checkpoint(filename, state_dicts, **metadata):
+    """Store flat state dicts as a JSON header followed by the raw tensor bytes, bypassing pickle.
+
+    state_dicts maps a checkpoint key (e.g. "model_state_dict") to a state dict of tensors,
+    metadata holds JSON serializable entries such as the epoch. Use ws.load_checkpoint to read it back.
+    """
+    header = {"metadata": metadata, "state_dicts": {}}
+    arrays = []
+    offset = 0
+    for key, state_dict in state_dicts.items():
+        entries = {}
+        for name, tensor in state_dict.items():
+            try:
+                array = np.ascontiguousarray(tensor.detach().cpu().numpy())
+            except TypeError:
+                # dtypes numpy cannot hold (e.g. bfloat16) are pickled instead
+                save_checkpoint(dict(metadata, **state_dicts), filename)
+                return
+            # align every tensor to its itemsize
+            padding = -offset % array.itemsize
+            if padding:
+                arrays.append(bytes(padding))
+                offset += padding
+            entries[name] = {
+                "dtype": array.dtype.str,
+                "shape": list(array.shape),
+                # relative to the end of the header
+                "offset": offset,
+                "nbytes": array.nbytes,
+            }
+            arrays.append(array)
+            offset += array.nbytes
+        header["state_dicts"][key] = {
+            "tensors": entries,
+            "metadata": getattr(state_dict, "_metadata", None),
+        }
+
+    header_bytes = json.dumps(header).encode("utf-8")
+    # pad the header with whitespace so that the tensor data starts on a 64 byte boundary
+    prefix_size = len(ws.tensor_checkpoint_magic) + 8 + len(header_bytes)
+    header_bytes += b" " * (-prefix_size % ws.tensor_checkpoint_alignment)
+    _write_atomically(
+        ws.tensor_checkpoint_magic,
+        struct.pack("<Q", len(header_bytes)),
+        header_bytes,
+        *arrays,
+        filename=filename
+    )
+
+
 def save_model(experiment_directory, filename, decoder, epoch):
 
     model_params_dir = ws.get_model_params_dir(experiment_directory, True)
 
-    torch.save(
-        {"epoch": epoch, "model_state_dict": decoder.state_dict()},
+    save_tensor_checkpoint(
         os.path.join(model_params_dir, filename),
+        {"model_state_dict": state_dict_to_cpu(decoder.state_dict())},
+        epoch=epoch,
     )
 
 
@@ -116,8 +260,8 @@ def save_optimizer(experiment_directory, filename, optimizer, epoch):
 
     optimizer_params_dir = ws.get_optimizer_params_dir(experiment_directory, True)
 
-    torch.save(
-        {"epoch": epoch, "optimizer_state_dict": optimizer.state_dict()},
+    save_checkpoint(
+        {"epoch": epoch, "optimizer_state_dict": state_dict_to_cpu(optimizer.state_dict())},
         os.path.join(optimizer_params_dir, filename),
     )
 
@@ -133,7 +277,7 @@ def load_optimizer(experiment_directory, filename, optimizer):
             'optimizer state dict "{}" does not exist'.format(full_filename)
         )
 
-    data = torch.load(full_filename)
+    data = ws.load_checkpoint(full_filename)
 
     optimizer.load_state_dict(data["optimizer_state_dict"])
 
@@ -144,11 +288,12 @@ def save_latent_vectors(experiment_directory, filename, latent_vec, epoch):
 
     latent_codes_dir = ws.get_latent_codes_dir(experiment_directory, True)
 
-    all_latents = latent_vec.state_dict()
+    all_latents = state_dict_to_cpu(latent_vec.state_dict())
 
-    torch.save(
-        {"epoch": epoch, "latent_codes": all_latents},
+    save_tensor_checkpoint(
         os.path.join(latent_codes_dir, filename),
+        {"latent_codes": all_latents},
+        epoch=epoch,
     )
 
 
@@ -161,7 +306,7 @@ def load_latent_vectors(experiment_directory, filename, lat_vecs):
     if not os.path.isfile(full_filename):
         raise Exception('latent state file "{}" does not exist'.format(full_filename))
 
-    data = torch.load(full_filename)
+    data = ws.load_checkpoint(full_filename)
 
     if isinstance(data["latent_codes"], torch.Tensor):
 
@@ -176,8 +321,7 @@ def load_latent_vectors(experiment_directory, filename, lat_vecs):
         if not lat_vecs.embedding_dim == data["latent_codes"].size()[2]:
             raise Exception("latent code dimensionality mismatch")
 
-        for i, lat_vec in enumerate(data["latent_codes"]):
-            lat_vecs.weight.data[i, :] = lat_vec
+        lat_vecs.weight.data.copy_(data["latent_codes"].reshape_as(lat_vecs.weight.data))
 
     else:
         lat_vecs.load_state_dict(data["latent_codes"])
@@ -191,33 +335,48 @@ def save_logs(
     epoch,
 ):
 
-    torch.save(
-        {
-            "epoch": epoch,
-            "loss": loss_log,
-        },
-        os.path.join(experiment_directory, ws.logs_filename),
+    buffer = io.BytesIO()
+    np.save(buffer, np.asarray(loss_log, dtype=np.float32))
+    _write_atomically(
+        buffer.getbuffer(),
+        filename=os.path.join(experiment_directory, ws.logs_filename),
+    )
+    _write_atomically(
+        json.dumps({"epoch": epoch}).encode("utf-8"),
+        filename=os.path.join(experiment_directory, ws.logs_meta_filename),
     )
 
 
 def load_logs(experiment_directory):
 
     full_filename = os.path.join(experiment_directory, ws.logs_filename)
+    meta_filename = os.path.join(experiment_directory, ws.logs_meta_filename)
+    legacy_filename = os.path.join(experiment_directory, ws.legacy_logs_filename)
+
+    if not os.path.isfile(full_filename) and os.path.isfile(legacy_filename):
+        # logs written with torch.save before the switch to .npy
+        data = torch.load(legacy_filename)
+        return (
+            data["loss"],
+            data["epoch"],
+        )
 
-    if not os.path.isfile(full_filename):
-        raise Exception('log file "{}" does not exist'.format(full_filename))
+    for filename in (full_filename, meta_filename):
+        if not os.path.isfile(filename):
+            raise Exception('log file "{}" does not exist'.format(filename))
 
-    data = torch.load(full_filename)
+    with open(meta_filename) as f:
+        meta = json.load(f)
 
     return (
-        data["loss"],
-        data["epoch"],
+        np.load(full_filename, mmap_mode="r"),
+        meta["epoch"],
     )
 
 
-def clip_logs(loss_log, epoch):
+def clip_logs(loss_log, iters_per_epoch, epoch):
 
-    iters_per_epoch = len(loss_log) // len(lr_log)
+    # a view for arrays, e.g. the memory mapped log returned by load_logs
     loss_log = loss_log[: (iters_per_epoch * epoch)]
 
     return loss_log
@@ -231,22 +390,59 @@ def get_spec_with_default(specs, key, default):
 
 
 def get_mean_latent_vector_magnitude(latent_vectors):
-    return torch.mean(torch.norm(latent_vectors.weight.data.detach(), dim=1))
+    return latent_vectors.weight.detach().pow(2).sum(1).sqrt_().mean()
+
+
+def copy_mean_latent_vector_magnitude_async(latent_vectors, out):
+    """Copy the mean latent vector magnitude into out (a pinned 0-dim CPU tensor) without syncing.
+
+    Returns a CUDA event, out holds the value once the event has completed (e.g. an epoch later).
+    """
+    out.copy_(get_mean_latent_vector_magnitude(latent_vectors), non_blocking=True)
+    event = torch.cuda.Event()
+    event.record()
+    return event
 
 
 def append_parameter_magnitudes(param_mag_log, model):
+    # one reduction and one device to host transfer per (device, dtype) group of parameters
+    groups = {}
+    for name, param in model.named_parameters():
+        groups.setdefault((param.device, param.dtype), []).append((name, param))
+    magnitudes = {}
+    for group in groups.values():
+        norms = torch.stack([param.detach().pow(2).sum() for _, param in group]).sqrt_().tolist()
+        magnitudes.update(zip([name for name, _ in group], norms))
     for name, param in model.named_parameters():
-        if len(name) > 7 and name[:7] == "module.":
+        magnitude = magnitudes[name]
+        if len(name) > 7 and name.startswith("module."):
             name = name[7:]
-        if name not in param_mag_log.keys():
-            param_mag_log[name] = []
-        param_mag_log[name].append(param.data.norm().item())
+        param_mag_log.setdefault(name, []).append(magnitude)
 
 
-def fourier_transform(x, L=5):
-    cosines = torch.cat([torch.cos(2**l*3.1415*x) for l in range(L)], -1)
-    sines = torch.cat([torch.sin(2**l*3.1415*x) for l in range(L)], -1)
-    transformed_x = torch.cat((cosines,sines),-1)
+_fourier_frequencies = {}
+
+
+def get_fourier_frequencies(L, device, dtype):
+    """Frequencies and phases of the [2, L, 1] cosine and sine features, cos(t) being sin(t + pi/2)."""
+    key = (L, device, dtype)
+    if key not in _fourier_frequencies:
+        freqs = math.pi * 2 ** torch.arange(L, device=device, dtype=dtype)
+        freqs = freqs.reshape(1, L, 1).repeat(2, 1, 1)
+        phases = torch.tensor([math.pi / 2, 0.0], device=device, dtype=dtype).reshape(2, 1, 1)
+        _fourier_frequencies[key] = (freqs, phases)
+    return _fourier_frequencies[key]
+
+
+def fourier_transform(x, L=5, dtype=None):
+    freqs, phases = get_fourier_frequencies(L, x.device, x.dtype)
+    # [..., 2, L, D] keeps the layout of the features: cos(2^0 pi x), cos(2^1 pi x), ..., sin(2^0 pi x), ...
+    # and works for any number of batch dimensions, e.g. [B, N, 3] queries
+    xf = torch.addcmul(phases, x.unsqueeze(-2).unsqueeze(-3), freqs)
+    transformed_x = xf.sin().reshape(*x.shape[:-1], -1)
+    # features are computed in the input precision, values in [-1, 1] are safe to emit e.g. in bfloat16
+    if dtype is not None:
+        transformed_x = transformed_x.to(dtype)
     return transformed_x
 
 
@@ -274,7 +470,28 @@ def add_common_args(arg_parser):
     )
 
 
+class _DeferredQueueHandler(logging.handlers.QueueHandler):
+    # merge the message arguments right away, so that objects modified after the logging call
+    # are logged as they were, the formatter is only applied on the listener thread
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+_log_queue_handler = None
+_log_listener = None
+
+
+def _stop_log_listener():
+    if _log_listener is not None:
+        _log_listener.stop()
+
+
 def configure_logging(args):
+    global _log_queue_handler, _log_listener
+
     logger = logging.getLogger()
     if args.debug:
         logger.setLevel(logging.DEBUG)
@@ -283,17 +500,37 @@ def configure_logging(args):
     else:
         logger.setLevel(logging.INFO)
     logger_handler = logging.StreamHandler()
-    formatter = logging.Formatter("MeshSdf - %(levelname)s - %(message)s")
+    formatter = logging.Formatter("MeshSdf - {levelname} - {message}", style="{")
     logger_handler.setFormatter(formatter)
-    logger.addHandler(logger_handler)
+    handlers = [logger_handler]
 
     if args.logfile is not None:
         file_logger_handler = logging.FileHandler(args.logfile)
         file_logger_handler.setFormatter(formatter)
-        logger.addHandler(file_logger_handler)
+        handlers.append(file_logger_handler)
 
-
-def decode_sdf(decoder, latent_vector, queries):
+    # configuring again replaces the previous listener instead of adding another one
+    if _log_listener is None:
+        # flush pending records on exit
+        atexit.register(_stop_log_listener)
+    else:
+        logger.removeHandler(_log_queue_handler)
+        _log_listener.stop()
+        for handler in _log_listener.handlers:
+            handler.close()
+
+    # the caller only merges the message and enqueues the record, formatting and writing happen on a background thread
+    log_queue = queue.Queue(-1)
+    _log_queue_handler = _DeferredQueueHandler(log_queue)
+    logger.addHandler(_log_queue_handler)
+    _log_listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    _log_listener.start()
+
+
+def decode_sdf(decoder, latent_vector, queries, latent_bias=None):
+    if latent_bias is not None:
+        # first layer latent contribution precomputed with decoder.latent_bias
+        return decoder(latent_vector, queries, latent_bias=latent_bias)
     num_samples = queries.shape[0]
     latent_repeat = latent_vector.expand(num_samples, -1)
     sdf = decoder(latent_repeat, queries)
@@ -302,35 +539,50 @@ def decode_sdf(decoder, latent_vector, queries):
 
 
 def get_projection(az, el, distance, focal_length=35, img_w=256, img_h=256, sensor_size_mm = 32.):
-    """Calculate 4x3 3D to 2D projection matrix given viewpoint parameters."""
+    """Calculate 4x3 3D to 2D projection matrix given viewpoint parameters.
+
+    az, el and distance may also be arrays of N viewpoints, in which case RT is returned as a [N, 3, 4] array.
+    K and RT are fresh, writable C-contiguous float32 arrays. Projections of scalar viewpoints are cached.
+    """
+    args = (az, el, distance, focal_length, img_w, img_h, sensor_size_mm)
+    if all(np.ndim(arg) == 0 for arg in args):
+        # hand out copies, so that callers can never modify the cached entry
+        K, RT = _get_projection_cached(*[float(arg) for arg in args])
+        return K.copy(), RT.copy()
+    return _compute_projection(*args)
+
+
+@functools.lru_cache(maxsize=4096)
+def _get_projection_cached(az, el, distance, focal_length, img_w, img_h, sensor_size_mm):
+    K, RT = _compute_projection(az, el, distance, focal_length, img_w, img_h, sensor_size_mm)
+    K.setflags(write=False)
+    RT.setflags(write=False)
+    return K, RT
+
+
+def _compute_projection(az, el, distance, focal_length, img_w, img_h, sensor_size_mm):
 
     # Calculate intrinsic matrix.
     f_u = focal_length * img_w  / sensor_size_mm
     f_v = focal_length * img_h  / sensor_size_mm
     u_0 = img_w / 2
     v_0 = img_h / 2
-    K = np.matrix(((f_u, 0, u_0), (0, f_v, v_0), (0, 0, 1)))
+    K = np.array(((f_u, 0, u_0), (0, f_v, v_0), (0, 0, 1)), dtype=np.float32)
 
     # Calculate rotation and translation matrices.
-    sa = np.sin(np.radians(az))
-    ca = np.cos(np.radians(az))
-    R_azimuth = np.transpose(np.matrix(((ca, 0, sa),
-                                          (0, 1, 0),
-                                          (-sa, 0, ca))))
-    se = np.sin(np.radians(el))
-    ce = np.cos(np.radians(el))
-    R_elevation = np.transpose(np.matrix(((1, 0, 0),
-                                          (0, ce, -se),
-                                          (0, se, ce))))
-    # fix up camera
-    se = np.sin(np.radians(90))
-    ce = np.cos(np.radians(90))
-    R_cam = np.transpose(np.matrix(((ce, -se, 0),
-                                          (se, ce, 0),
-                                          (0, 0, 1))))
-    T_world2cam = np.transpose(np.matrix((0,
-                                           0,
-                                           distance)))
-    RT = np.hstack((R_cam@R_elevation@R_azimuth, T_world2cam))
+    az, el, distance = np.broadcast_arrays(np.radians(az), np.radians(el), np.asarray(distance, dtype=np.float64))
+    sa = np.sin(az)
+    ca = np.cos(az)
+    se = np.sin(el)
+    ce = np.cos(el)
+    zeros = np.zeros_like(sa)
+    # closed form of R_cam @ R_elevation @ R_azimuth, where the camera fix-up is a 90 degrees roll
+    RT = np.stack((
+        np.stack((se*sa, ce, se*ca, zeros), -1),
+        np.stack((-ca, zeros, sa, zeros), -1),
+        np.stack((ce*sa, -se, ce*ca, distance), -1),
+    ), -2)
+    # contiguous float32, torch.from_numpy can wrap the arrays handed out by get_projection without a copy
+    RT = np.ascontiguousarray(RT, dtype=np.float32)
 
     return K, RT
@@ -1,14 +1,19 @@
 #!/usr/bin/env python3
 
+import collections
 import json
 import os
+import struct
+import numpy as np
 import torch
 import pdb
 
 model_params_subdir = "ModelParameters"
 optimizer_params_subdir = "OptimizerParameters"
 latent_codes_subdir = "LatentCodes"
-logs_filename = "Logs.pth"
+logs_filename = "Logs.npy"
+logs_meta_filename = "Logs.meta.json"
+legacy_logs_filename = "Logs.pth"
 reconstructions_subdir = "Reconstructions"
 reconstruction_meshes_subdir = "Meshes"
 reconstruction_codes_subdir = "Codes"
@@ -17,6 +22,36 @@ optimizations_meshes_subdir = "Meshes"
 optimizations_codes_subdir = "Codes"
 specifications_filename = "specs.json"
 data_source_map_filename = ".datasources.json"
+tensor_checkpoint_magic = b"MESHSDFT"
+tensor_checkpoint_alignment = 64
+
+
+def load_checkpoint(filename):
+    """Load a checkpoint written by either torch.save or lib.utils.save_tensor_checkpoint.
+
+    Tensors of the raw format are memory mapped instead of being unpickled.
+    """
+    with open(filename, "rb") as f:
+        magic = f.read(len(tensor_checkpoint_magic))
+        if magic != tensor_checkpoint_magic:
+            return torch.load(filename)
+        (header_size,) = struct.unpack("<Q", f.read(8))
+        header = json.loads(f.read(header_size).decode("utf-8"))
+
+    data_start = len(tensor_checkpoint_magic) + 8 + header_size
+    raw = np.memmap(filename, dtype=np.uint8, mode="c", offset=data_start)
+    data = dict(header["metadata"])
+    for key, entries in header["state_dicts"].items():
+        state_dict = collections.OrderedDict()
+        for name, entry in entries["tensors"].items():
+            array = raw[entry["offset"] : entry["offset"] + entry["nbytes"]]
+            state_dict[name] = torch.from_numpy(
+                array.view(entry["dtype"]).reshape(entry["shape"])
+            )
+        if entries["metadata"] is not None:
+            state_dict._metadata = collections.OrderedDict(entries["metadata"])
+        data[key] = state_dict
+    return data
 
 
 def load_experiment_specifications(experiment_directory):
@@ -40,7 +75,7 @@ def load_cam_model_parameters(experiment_directory, checkpoint, encoder):
     if not os.path.isfile(filename):
         raise Exception('model state dict "{}" does not exist'.format(filename))
 
-    data = torch.load(filename)
+    data = load_checkpoint(filename)
 
     encoder.load_state_dict(data["model_state_dict"])
 
@@ -55,7 +90,7 @@ def load_model_parameters(experiment_directory, checkpoint, decoder):
     if not os.path.isfile(filename):
         raise Exception('model state dict "{}" does not exist'.format(filename))
 
-    data = torch.load(filename)
+    data = load_checkpoint(filename)
 
     decoder.load_state_dict(data["model_state_dict"])
 
@@ -70,7 +105,7 @@ def load_model_parameters_og(experiment_directory, checkpoint, decoder):
     if not os.path.isfile(filename):
         raise Exception('model state dict "{}" does not exist'.format(filename))
 
-    data = torch.load(filename)
+    data = load_checkpoint(filename)
 
     decoder.load_state_dict(data["model_state_dict"])
 
@@ -84,7 +119,7 @@ def load_model_parameters(experiment_directory, checkpoint, encoder, decoder):
     if not os.path.isfile(filename):
         raise Exception('model state dict "{}" does not exist'.format(filename))
 
-    data = torch.load(filename)
+    data = load_checkpoint(filename)
     encoder.load_state_dict(data["model_state_dict"])
 
     filename = os.path.join(
@@ -93,7 +128,7 @@ def load_model_parameters(experiment_directory, checkpoint, encoder, decoder):
     if not os.path.isfile(filename):
         raise Exception('model state dict "{}" does not exist'.format(filename))
 
-    data = torch.load(filename)
+    data = load_checkpoint(filename)
     decoder.load_state_dict(data["model_state_dict"])
 
     return data["epoch"]
@@ -106,7 +141,7 @@ def load_model_parameters_pretrained(experiment_directory, checkpoint, encoder,
     if not os.path.isfile(filename):
         raise Exception('model state dict "{}" does not exist'.format(filename))
 
-    data = torch.load(filename)
+    data = load_checkpoint(filename)
     encoder.load_state_dict(data["model_state_dict"])
 
     filename = os.path.join(
@@ -115,7 +150,7 @@ def load_model_parameters_pretrained(experiment_directory, checkpoint, encoder,
     if not os.path.isfile(filename):
         raise Exception('model state dict "{}" does not exist'.format(filename))
 
-    data = torch.load(filename)
+    data = load_checkpoint(filename)
     decoder.load_state_dict(data["model_state_dict"])
 
     return data["epoch"]
@@ -160,7 +195,7 @@ def load_latent_vectors(experiment_directory, checkpoint):
             + " for checkpoint '{}'".format(experiment_directory, checkpoint)
         )
 
-    data = torch.load(filename)
+    data = load_checkpoint(filename)
 
     if isinstance(data["latent_codes"], torch.Tensor):
 
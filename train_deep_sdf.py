@@ -9,6 +9,7 @@ import os
 import logging
 import math
 import json
+import numpy as np
 import time
 import pdb
 
@@ -121,7 +122,9 @@ def main_function(experiment_directory, resolution):
         ]
     )
 
-    loss_log = []
+    iters_per_epoch = len(sdf_loader)
+    loss_log = np.zeros(num_epochs * iters_per_epoch, dtype=np.float32)
+    num_iters = 0
 
     start_epoch = 1
 
@@ -138,6 +141,19 @@ def main_function(experiment_directory, resolution):
             lat_vecs.embedding_dim,
         )
     )
+    # the latent code magnitude is read back one epoch after it is queued, avoiding a sync
+    log_latent_magnitude = logging.getLogger().isEnabledFor(logging.DEBUG)
+    latent_magnitude = torch.empty((), pin_memory=True) if log_latent_magnitude else None
+    latent_magnitude_event = None
+
+    def log_queued_latent_magnitude(epoch):
+        latent_magnitude_event.synchronize()
+        logging.debug(
+            "mean latent vector magnitude after epoch {}: {}".format(
+                epoch, latent_magnitude.item()
+            )
+        )
+
     # train parameterization
     for epoch in range(start_epoch, num_epochs + 1):
 
@@ -176,7 +192,8 @@ def main_function(experiment_directory, resolution):
 
             batch_loss.backward()
 
-            loss_log.append(batch_loss.item())
+            loss_log[num_iters] = batch_loss.item()
+            num_iters += 1
 
             if grad_clip is not None:
                 torch.nn.utils.clip_grad_norm_(decoder.parameters(), grad_clip)
@@ -185,14 +202,24 @@ def main_function(experiment_directory, resolution):
 
         logging.info("epoch {}...".format(epoch))
 
+        if log_latent_magnitude:
+            if latent_magnitude_event is not None:
+                log_queued_latent_magnitude(epoch - 1)
+            latent_magnitude_event = copy_mean_latent_vector_magnitude_async(
+                lat_vecs, latent_magnitude
+            )
+
         if epoch % log_frequency == 0:
             save_latest(epoch)
             save_logs(
                 experiment_directory,
-                loss_log,
+                loss_log[:num_iters],
                 epoch,
             )
 
+    if latent_magnitude_event is not None:
+        log_queued_latent_magnitude(num_epochs)
+
     # store reconstructions
     decoder.eval()
     reconstruction_dir = get_reconstruction_dir(experiment_directory, True)